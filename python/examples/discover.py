@@ -18,7 +18,7 @@ if __name__ == '__main__':
     # Start the search!
     while searching:
         # discover() takes three args: The sockets that we created earlier, and a list of known bot ip addresses.
-        #   The third arg is optional, and is the amount of time discover() will sleep after it requests a response.
+        #   The third arg is optional, and is the amount of time discover() will wait for responses.
         #   If you don't specify a sleep amount, it defaults to 1 second.
         result = makerbotapi.makerbotapi.discover(
             sockets, knownBots.keys(), sleepAmount)
@@ -24,11 +24,19 @@ import socket
 import time
 import urllib
 import urllib2
+import httplib
 import ctypes
+import ctypes.util
 import struct
 import png
 import os
-import thread
+import re
+import itertools
+import collections
+import threading
+import select
+import traceback
+from array import array
 
 
 try:
@@ -36,6 +44,53 @@ try:
 except:
     from StringIO import StringIO
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Use the faster ujson codec if available
+try:
+    import ujson as _json
+except ImportError:
+    _json = json
+
+_loads = _json.loads
+_dumps = _json.dumps
+
+
+def _load_libyuv():
+    """Load libyuv for converting camera images, if it is installed.
+
+    Returns:
+      A ctypes library handle or None.
+    """
+    path = ctypes.util.find_library('yuv')
+    if path is None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+        functions = [lib.YUY2ToARGB, lib.ARGBToRAW]
+    except (OSError, AttributeError):
+        return None
+    for function in functions:
+        function.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                             ctypes.c_char_p, ctypes.c_int,
+                             ctypes.c_int, ctypes.c_int]
+        function.restype = ctypes.c_int
+    return lib
+
+_libyuv = _load_libyuv()
+
+
+def _buffer_address(data):
+    """Returns the address of the contents of a read-only buffer object."""
+    address = ctypes.c_void_p()
+    length = ctypes.c_ssize_t()
+    ctypes.pythonapi.PyObject_AsReadBuffer(
+        ctypes.py_object(data), ctypes.byref(address), ctypes.byref(length))
+    return address.value
+
 
 class Error(Exception):
 
@@ -67,6 +122,11 @@ class NotAuthenticated(Error):
     """Access to privileged method call denied."""
 
 
+class RPCTimeout(Error):
+
+    """No response to a JSON RPC request within rpc_timeout."""
+
+
 class UnexpectedJSONResponse(Error):
     # Here's what the JSON should look like (When a process is not running):
     #
@@ -75,8 +135,18 @@ class UnexpectedJSONResponse(Error):
     """Unexpected JSON Response."""
 
 
+# Exceptions raised for JSON RPC error codes, MakerBotError for all others
+_RPC_ERRORS = {
+    # 'method not found' means the current connection is not authenticated
+    -32601: NotAuthenticated,
+}
+
+
 class Toolhead(object):
 
+    __slots__ = ('tool_id', 'filament_presence', 'preheating', 'index',
+                 'tool_present', 'current_temperature', 'target_temperature')
+
     def __init__(self):
         self.tool_id = None
         self.filament_presence = None
@@ -114,7 +184,7 @@ class Config(object):
             print 'found config'
             with open(self.fname) as json_data_file:
                 try:
-                    self.data = json.load(json_data_file)
+                    self.data = _loads(json_data_file.read())
                     print 'Loaded config'
                 except ValueError, e:
                     print 'Not a valid JSON config file!'
@@ -122,7 +192,7 @@ class Config(object):
             print 'No config.json found. Creating empty config'
             with open(self.fname, 'w') as outfile:
                 try:
-                    json.dump(self.emptyConfig, outfile)
+                    outfile.write(_dumps(self.emptyConfig))
                     self.data = self.emptyConfig
                     print 'Created config'
                 except ValueError, e:
@@ -134,12 +204,21 @@ class Config(object):
         before this if you want your old data saved.
 
         """
-        with open(self.fname, 'w') as outfile:
-            try:
-                json.dump(self.data, outfile)
-                print 'Saved config'
-            except ValueError, e:
-                print 'Could not save config'
+        tmp_fname = self.fname + '.tmp'
+        try:
+            with open(tmp_fname, 'w') as outfile:
+                outfile.write(_dumps(self.data))
+        except ValueError, e:
+            print 'Could not save config'
+            os.remove(tmp_fname)
+            return
+        try:
+            os.rename(tmp_fname, self.fname)
+        except OSError:
+            # Windows does not allow renaming over an existing file
+            os.remove(self.fname)
+            os.rename(tmp_fname, self.fname)
+        print 'Saved config'
 
     def getBotInfo(self, botSerial):
         """Allows you to see some basic info about the bot
@@ -258,7 +337,7 @@ def discover(sockets, knownBotIps=None, sleep=1):
         Args:
             sockets: A list of a broadcast socket and an answer socket, in that order.
             knownBotIps: A list of known bot ips, so we don't duplicate ips in our result.
-            sleep: How long this function should sleep after checking for a response.
+            sleep: How long this function should wait for responses.
                 Users can override this, but the default value is 1 second.
 
         Returns:
@@ -274,22 +353,32 @@ def discover(sockets, knownBotIps=None, sleep=1):
     answersocket = sockets[1]
 
     broadcast_dict = {"command": "broadcast"}
-    discover_request = json.dumps(broadcast_dict)
+    discover_request = _dumps(broadcast_dict)
 
     answers = []
 
     broadcastsocket.sendto(discover_request, (bcaddr, target_port))
-    time.sleep(sleep)
-    try:
-        data, fromaddr = answersocket.recvfrom(1024)
-        ip = fromaddr[0]
-        if ip not in knownBotIps:
-            infodic = json.loads(data)
-            machine_name = infodic['machine_name']
-            serial = infodic['iserial']
-            answers.append((fromaddr[0], machine_name, serial),)
-    except socket.error:
-        '''no data yet'''
+    # Collect all answers arriving within the sleep window
+    end_time = time.time() + sleep
+    while True:
+        readable, _, _ = select.select(
+            [answersocket], [], [], max(0, end_time - time.time()))
+        if not readable:
+            break
+        try:
+            data, fromaddr = answersocket.recvfrom(1024)
+        except socket.error:
+            pass
+        else:
+            ip = fromaddr[0]
+            if ip not in knownBotIps and ip not in [answer[0] for answer in answers]:
+                infodic = _loads(data)
+                machine_name = infodic['machine_name']
+                serial = infodic['iserial']
+                answers.append((fromaddr[0], machine_name, serial),)
+        # Stop on time even while datagrams keep arriving
+        if time.time() >= end_time:
+            break
     return answers
 
 
@@ -302,8 +391,13 @@ class BotState(object):
     STATE_IDLE = 'idle'
     # TODO: find out other states
 
+    __slots__ = ('step', 'extruder_temp', 'state', 'toolheads',
+                 'preheat_percent', 'current_process')
+
     def __init__(self):
         self.step = None
+        self.extruder_temp = None
+        self.state = None
         self.toolheads = []
         self.preheat_percent = None
         self.current_process = None
@@ -331,18 +425,170 @@ class CurrentBotProcess(object):
         self.progress = None
 
 
+# Marks keys absent from a response, where None is a valid value
+_MISSING = object()
+
+# Attributes copied from the get_system_information response
+_CURRENT_PROCESS_ATTRS = ('username',
+                          'name',
+                          'cancellable',
+                          'temperature_settings',
+                          'tool_index',
+                          'step',
+                          'complete',
+                          'error',
+                          'cancelled',
+                          'reason',
+                          'id',
+                          'methods',
+                          'progress')
+
+
+# Start of a JSON RPC message or batch
+_RPC_MESSAGE_START = re.compile(r'[{\[]')
+# Groups: 1 string start, 2 opening and 3 closing bracket
+_RPC_TOKEN = re.compile(r'(")|([{\[])|([}\]])')
+# Groups: 1 string end, 2 escape
+_RPC_STRING_TOKEN = re.compile(r'(")|(\\)')
+
+
+def _scan_rpc_message(buffer, pos, endpos, depth, in_string):
+    """Scan for the end of a JSON RPC message without decoding it.
+
+    Scanning starts at the opening bracket of the message with depth 0 and
+    can be continued where it stopped once more data arrived.
+
+    Args:
+      buffer: A string or bytearray containing the message
+      pos: Position to continue scanning at
+      endpos: End of the received data in buffer
+      depth: Bracket nesting depth at pos
+      in_string: Whether pos is inside a JSON string
+
+    Returns:
+      A tuple (pos, depth, in_string) describing where scanning stopped. The
+      message is complete, ending just before pos, if depth is 0.
+    """
+    while True:
+        if in_string:
+            match = _RPC_STRING_TOKEN.search(buffer, pos, endpos)
+            if match is None:
+                return endpos, depth, True
+            pos = match.end()
+            if match.lastindex == 2:
+                if pos == endpos:
+                    # Continue at the escape once the escaped character is in
+                    return pos - 1, depth, True
+                pos += 1
+            else:
+                in_string = False
+        else:
+            match = _RPC_TOKEN.search(buffer, pos, endpos)
+            if match is None:
+                return endpos, depth, False
+            pos = match.end()
+            if match.lastindex == 1:
+                in_string = True
+            elif match.lastindex == 2:
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos, 0, False
+
+
+class _Reactor(object):
+
+    """Reads the JSON RPC sockets of all Makerbot instances in one thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._thread = None
+        self._wakeup_socket = None
+        self._wakeup_receiver = None
+
+    def register(self, sock, handler):
+        """Call handler whenever sock becomes readable."""
+        with self._lock:
+            self._handlers[sock] = handler
+            if self._thread is None:
+                if hasattr(socket, 'socketpair'):
+                    self._wakeup_receiver, self._wakeup_socket = socket.socketpair()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup()
+
+    def unregister(self, sock):
+        with self._lock:
+            self._handlers.pop(sock, None)
+        self._wakeup()
+
+    def _wakeup(self):
+        """Make the reader thread pick up changed registrations."""
+        if self._wakeup_socket is not None:
+            self._wakeup_socket.send('x')
+
+    def _run(self):
+        if self._wakeup_receiver is not None:
+            timeout = None
+        else:
+            # No socketpair (Windows), poll for changed registrations
+            timeout = 0.1
+
+        while True:
+            with self._lock:
+                sockets = list(self._handlers)
+            if self._wakeup_receiver is not None:
+                sockets.append(self._wakeup_receiver)
+            try:
+                readable, _, _ = select.select(sockets, [], [], timeout)
+            except (select.error, socket.error, ValueError):
+                # A socket was closed while waiting, it is unregistered by now
+                continue
+            for sock in readable:
+                if sock is self._wakeup_receiver:
+                    sock.recv(4096)
+                    continue
+                with self._lock:
+                    handler = self._handlers.get(sock)
+                if handler is None:
+                    continue
+                try:
+                    handler()
+                except Exception:
+                    traceback.print_exc()
+                    self.unregister(sock)
+
+_reactor = _Reactor()
+
+
 class Makerbot(object):
 
     """MakerBot."""
 
-    def __init__(self, ip, auth_code=None, auto_connect=True):
+    # Request/response RPCs are small, don't delay them with Nagle's
+    # algorithm. Keepalive detects dead connections between polls.
+    default_socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                              (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def __init__(self, ip, auth_code=None, auto_connect=True,
+                 socket_options=None):
         self.auth_code = auth_code
         self.auth_timeout = 120
+        self.rpc_timeout = 3
+        # The connection is dropped if a message does not fit into this
+        self.rpc_max_message_size = 16 * 1024 * 1024
         self.client_id = 'MakerWare'
         self.client_secret = 'python-makerbotapi'
+        self.fcgi_initial_retry_interval = 0.25
         self.fcgi_retry_interval = 5
         self.host = ip
         self.jsonrpc_port = 9999
+        # Kept open between FCGI requests, one request at a time
+        self._http = httplib.HTTPConnection(ip, timeout=5)
+        self._http_lock = threading.Lock()
 
         self.builder = None
         self.commit = None
@@ -354,22 +600,43 @@ class Makerbot(object):
         self.pid = None
         self.bot_type = None
 
+        # Serialized once for the handshake, replace it instead of modifying
         self.default_params = {'username': 'conveyor',
                                'host_version': '1.0'}
-        self.request_id = -1
+        # count().next is atomic under the GIL and runs entirely in C
+        self._next_request_id = itertools.count(0).next
+        # Serialized payloads of calls with fixed params, see
+        # _generate_json_rpc()
+        self._rpc_templates = {}
 
         self.debug_jsonrpc = False
         self.debug_fcgi = False
 
-        self.rpc_unsolicited_messages = []
-        self.rpc_id_responses = {}
+        # Only the latest unsolicited messages are kept
+        self.rpc_unsolicited_messages = collections.deque(maxlen=256)
+        # Requests waiting for a response, request id -> threading.Event
+        self._rpc_pending = {}
+        self._rpc_results = {}
+        self._rpc_lock = threading.Lock()
         # TODO: implement consumers to remove obsolete solicited/unsolicited
         # messages
 
+        # Received data not yet handled is kept in _rpc_buffer[:_rpc_buffer_len]
+        self._rpc_buffer = bytearray(65536)
+        self._rpc_buffer_len = 0
+        # Start of the incomplete message in _rpc_buffer, or -1, and where
+        # _scan_rpc_message() continues once more data arrived
+        self._rpc_message_start = -1
+        self._rpc_scan = (0, 0, False)
         self.rpc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if socket_options is None:
+            socket_options = self.default_socket_options
+        for level, option, value in socket_options:
+            self.rpc_socket.setsockopt(level, option, value)
+        # Bound connecting and sending, reads only happen once data arrived
+        self.rpc_socket.settimeout(self.rpc_timeout)
         if auto_connect:
             self._connect_json_rpc()
-            thread.start_new_thread(self._rpc_reader_thread, ())
             self.do_handshake()
 
     def _debug_print(self, protocol, direction, content):
@@ -381,10 +648,13 @@ class Makerbot(object):
         """Create a socket connection to the MakerBot JSON RPC interface."""
         self.rpc_socket.connect((self.host, self.jsonrpc_port),)
         self.jsonrpc_connected = True
+        _reactor.register(self.rpc_socket, self._rpc_socket_readable)
 
     def _disconnect_json_rpc(self):
         """Disconnect from the MakerBot JSON RPC interface."""
-        pass
+        _reactor.unregister(self.rpc_socket)
+        self.rpc_socket.close()
+        self.jsonrpc_connected = False
 
     def _generate_json_rpc(self, method, params, id):
         """Generate a JSON RPC payload.
@@ -398,39 +668,62 @@ class Makerbot(object):
         Returns:
           A JSON RPC formatted string.
         """
+        if params == "" or params is self.default_params:
+            # Calls without params and the handshake with default_params
+            # are serialized once per method, only the id is filled in.
+            fixed = params is self.default_params
+            template = self._rpc_templates.get(method)
+            if template is None or template[0] != fixed:
+                payload = _dumps(self._json_rpc_request(method, params))
+                template = (fixed, payload[1:])
+                self._rpc_templates[method] = template
+            return '{"id": %d, %s' % (id, template[1])
+        jsonrpc = self._json_rpc_request(method, params)
+        jsonrpc['id'] = id
+        return _dumps(jsonrpc)
+
+    def _json_rpc_request(self, method, params):
+        """Create a JSON RPC request object without id."""
         if params == "":
-            jsonrpc = {'id' : id, 'jsonrpc': '2.0', 'method': method}
-        else:
-            jsonrpc = {'id': id,
-                   'jsonrpc': '2.0',
-                   'method': method,
-                   'params': params}
+            return {'jsonrpc': '2.0', 'method': method}
         # TODO(n-i-x): Do some error checking here
-        return json.dumps(jsonrpc)
-
-    def _get_request_id(self):
-        """Increment the request id counter."""
-        self.request_id += 1
-        return self.request_id
+        return {'jsonrpc': '2.0',
+                'method': method,
+                'params': params}
 
     def _send_fcgi(self, path, query_args):
         """Send an FCGI request to the MakerBot FCGI interface."""
         encoded_args = urllib.urlencode(query_args)
 
-        url = 'http://%s/%s?%s' % (self.host, path, encoded_args)
+        url = '/%s?%s' % (path, encoded_args)
 
         if self.debug_fcgi:
-            self._debug_print('FCGI', 'REQUEST', url)
+            self._debug_print('FCGI', 'REQUEST', 'http://%s%s' % (self.host, url))
+
+        with self._http_lock:
+            try:
+                self._http.request('GET', url)
+                response = self._http.getresponse()
+            except socket.timeout:
+                # The bot did not answer, retrying would only wait again
+                self._http.close()
+                raise
+            except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                    socket.error):
+                # The kept-alive connection was closed, reconnect once
+                self._http.close()
+                self._http.request('GET', url)
+                response = self._http.getresponse()
+
+            if response.status != httplib.OK:
+                raise urllib2.HTTPError('http://%s%s' % (self.host, url),
+                                        response.status, response.reason,
+                                        response.msg, response)
 
-        response = urllib2.urlopen(url)
-        if self.debug_fcgi:
             content = response.read()
+        if self.debug_fcgi:
             self._debug_print('FCGI', 'RESPONSE', content)
-            result = json.loads(content)
-        else:
-            result = json.load(response)
-
-        return result
+        return _loads(content)
 
     def _send_rpc(self, jsonrpc):
         """Send an RPC to the MakerBot JSON RPC interface.
@@ -443,51 +736,99 @@ class Makerbot(object):
 
         self.rpc_socket.sendall(jsonrpc)
 
-    def _wait_for_rpc_response(self, requestid, timeout=3):
-        too_late = time.time() + timeout
-        while time.time() < too_late:
-            if requestid in self.rpc_id_responses:
-                return self.rpc_id_responses.pop(requestid)
-        return None
-
-    def _rpc_reader_thread(self):
-        buffer = ''
+    def _rpc_socket_readable(self):
+        """Read and handle the available data on the JSON RPC socket."""
+        if self._rpc_buffer_len == len(self._rpc_buffer):
+            if self._rpc_buffer_len >= self.rpc_max_message_size:
+                self._debug_print('JSONRPC', 'ERROR',
+                                  'message larger than %d bytes, disconnecting'
+                                  % self.rpc_max_message_size)
+                self._disconnect_json_rpc()
+                return
+            # Make room for messages larger than the buffer
+            self._rpc_buffer.extend(bytearray(len(self._rpc_buffer)))
+        received = self.rpc_socket.recv_into(
+            memoryview(self._rpc_buffer)[self._rpc_buffer_len:])
+        if not received:
+            # Connection closed by the bot
+            _reactor.unregister(self.rpc_socket)
+            self.jsonrpc_connected = False
+            return
+        self._rpc_buffer_len += received
+        self._handle_rpc_buffer()
+
+    def _handle_rpc_buffer(self):
+        """Handle all complete rpc messages in the receive buffer.
+
+        Only data received since the last call is scanned and each message is
+        decoded once, so large messages arriving in many pieces take linear
+        time. Invalid messages and data outside of messages are skipped.
+        """
+        buffer = self._rpc_buffer
+        length = self._rpc_buffer_len
+        start = self._rpc_message_start
+        pos, depth, in_string = self._rpc_scan
         while True:
-            response = self.rpc_socket.recv(4096)
-            buffer += response
-            message, rest = self._rpc_get_next_message(buffer)
-            while message != None:
-                self._handle_response(message)
-                buffer = rest
-                message, rest = self._rpc_get_next_message(buffer)
-            buffer = rest
-
-    def _rpc_get_next_message(self, buffer):
-        """get the first rpc message from the stream.
-        Returns a tuple (first message, rest of the buffer)"""
-        if len(buffer) == 0:
-            return None, buffer
-        parenindex = 0
-        assert buffer.startswith('{'), 'invalid buffer state %s' % buffer
-        pos = 0
-        for char in buffer:
-            pos += 1
-            if char == '{':
-                parenindex += 1
-            if char == '}':
-                parenindex -= 1
-                if parenindex == 0:
-                    message = buffer[0:pos]
-                    return message, buffer[pos:]
-        return None, buffer
-
-    def _handle_response(self, response):
+            if start < 0:
+                match = _RPC_MESSAGE_START.search(buffer, pos, length)
+                if match is None:
+                    self._skip_rpc_data(buffer[pos:length])
+                    pos = length
+                    break
+                start = match.start()
+                self._skip_rpc_data(buffer[pos:start])
+                pos, depth, in_string = start, 0, False
+            pos, depth, in_string = _scan_rpc_message(buffer, pos, length,
+                                                      depth, in_string)
+            if depth:
+                break
+            self._handle_rpc_message(memoryview(buffer)[start:pos].tobytes())
+            start = -1
+
+        # Move the incomplete message to the start of the buffer
+        handled = start if start >= 0 else pos
+        if handled:
+            buffer[:length - handled] = buffer[handled:length]
+            self._rpc_buffer_len = length - handled
+            if start >= 0:
+                start -= handled
+            pos -= handled
+        self._rpc_message_start = start
+        self._rpc_scan = (pos, depth, in_string)
+
+    def _skip_rpc_data(self, data):
+        """Report data found between JSON RPC messages."""
+        if data.strip():
+            self._debug_print('JSONRPC', 'INVALID', data)
+
+    def _handle_rpc_message(self, message):
+        """Decode and dispatch a complete JSON RPC message or batch."""
         if self.debug_jsonrpc:
-            self._debug_print('JSONRPC', 'RESPONSE', response)
-        dic = json.loads(response)
-        if 'id' in dic:
-            response_id = dic['id']
-            self.rpc_id_responses[response_id] = dic
+            self._debug_print('JSONRPC', 'RESPONSE', message)
+        try:
+            dic = _loads(message)
+        except ValueError:
+            self._debug_print('JSONRPC', 'INVALID', message)
+            return
+        if isinstance(dic, list):
+            # Responses to a batch request
+            for response in dic:
+                if isinstance(response, dict):
+                    self._handle_response_obj(response)
+        else:
+            self._handle_response_obj(dic)
+
+    def _handle_response_obj(self, dic):
+        # The bot does not put the id first, so responses can not be told
+        # apart from notifications without parsing them.
+        response_id = dic.get('id')
+        if response_id is not None:
+            with self._rpc_lock:
+                # Responses nobody is waiting for (anymore) are dropped
+                event = self._rpc_pending.get(response_id)
+                if event is not None:
+                    self._rpc_results[response_id] = dic
+                    event.set()
         else:
             self.rpc_unsolicited_messages.append(dic)
 
@@ -505,6 +846,7 @@ class Makerbot(object):
                       'client_secret': self.client_secret,
                       'answer_code': answer_code}
         start_time = time.time()
+        delay = 0
         while True:
             response = self._send_fcgi('auth', query_args)
 
@@ -517,10 +859,17 @@ class Makerbot(object):
                                 "Press a button on printer to disable pairing mode."
                 raise AuthenticationError(error_message)
 
-            if time.time() - start_time >= self.auth_timeout:
+            elapsed = time.time() - start_time
+            if elapsed >= self.auth_timeout:
                 raise AuthenticationTimeout
 
-            time.sleep(self.fcgi_retry_interval)
+            # Poll quickly at first, backing off to fcgi_retry_interval
+            if delay:
+                delay = min(self.fcgi_retry_interval, delay * 1.6)
+            else:
+                delay = min(self.fcgi_retry_interval,
+                            self.fcgi_initial_retry_interval)
+            time.sleep(min(delay, self.auth_timeout - elapsed))
 
     def authenticate_json_rpc(self):
         """Authenticate to the MakerBot JSON RPC interface."""
@@ -531,16 +880,21 @@ class Makerbot(object):
     def do_handshake(self):
         """Perform handshake with MakerBot over JSON RPC."""
         response = self.rpc_request_response('handshake', self.default_params)
-        if 'result' in response and len(response.get('result')):
-            self.builder = response['result'].get('builder')
-            self.commit = response['result'].get('commit')
-            self.firmware_version = response['result'].get('firmware_version')
-            self.iserial = response['result'].get('iserial')
-            self.machine_name = response['result'].get('machine_name')
-            self.machine_type = response['result'].get('machine_type')
-            self.vid = response['result'].get('vid')
-            self.pid = response['result'].get('pid')
-            self.bot_type = response['result'].get('bot_type')
+        self._parse_handshake(response)
+
+    def _parse_handshake(self, response):
+        """Store the bot identification of a handshake response."""
+        result = response.get('result')
+        if result:
+            self.builder = result.get('builder')
+            self.commit = result.get('commit')
+            self.firmware_version = result.get('firmware_version')
+            self.iserial = result.get('iserial')
+            self.machine_name = result.get('machine_name')
+            self.machine_type = result.get('machine_type')
+            self.vid = result.get('vid')
+            self.pid = result.get('pid')
+            self.bot_type = result.get('bot_type')
 
     def get_access_token(self, context):
         """Get an OAuth access token from the MakerBot FCGI interface.
@@ -573,30 +927,101 @@ class Makerbot(object):
 
         Returns:
           A tuple total_blob_size, image_width, image_height, pixel_format, latest_cached_image
+          The image data is returned as a buffer object.
         """
         access_token = self.get_access_token('camera')
         url = 'http://%s/camera?token=%s' % (self.host, access_token)
         data = urllib2.urlopen(url).read()
-        return struct.unpack('!IIII{0}s'.format(len(data) - ctypes.sizeof(ctypes.c_uint32 * 4)), data)
+        # The image is returned as a buffer sharing the data, not as a copy
+        header = struct.unpack_from('!IIII', data)
+        return header + (buffer(data, struct.calcsize('!IIII')),)
 
     def rpc_request_response(self, method, params):
-        request_id = self._get_request_id()
+        request = self._send_rpc_request(method, params)
+        try:
+            self._wait_rpc_response(request, self.rpc_timeout)
+        finally:
+            response = self._pop_rpc_response(request)
+        self._check_rpc_response(response)
+        return response
+
+    def _send_rpc_request(self, method, params):
+        """Send an RPC without waiting for its response.
+
+        Returns:
+          A tuple (request id, threading.Event set once the response arrived)
+          to be passed to _pop_rpc_response.
+        """
+        request_id = self._next_request_id()
         jsonrpc = self._generate_json_rpc(
             method, params, request_id)
-        self._send_rpc(jsonrpc)
-        response = self._wait_for_rpc_response(request_id)
+        event = threading.Event()
+        with self._rpc_lock:
+            self._rpc_pending[request_id] = event
+        try:
+            self._send_rpc(jsonrpc)
+        except:
+            self._pop_rpc_response((request_id, event))
+            raise
+        return request_id, event
+
+    def _wait_rpc_response(self, request, timeout):
+        request[1].wait(max(0, timeout))
+
+    def _pop_rpc_response(self, request):
+        """Stop waiting for a request and return its response, or None."""
+        # Also drop a response that arrived after the timeout
+        with self._rpc_lock:
+            del self._rpc_pending[request[0]]
+            return self._rpc_results.pop(request[0], None)
+
+    def _batch_rpc_request_response(self, calls):
+        """Send several RPCs in one JSON RPC batch request.
+
+        Args:
+          calls: list of (method, params) tuples
+
+        Returns:
+          A list with the response to each call, in the order of calls.
+        """
+        request_ids = [self._next_request_id() for _ in calls]
+        jsonrpc = '[%s]' % ', '.join(
+            self._generate_json_rpc(method, params, request_id)
+            for (method, params), request_id in zip(calls, request_ids))
+        events = [threading.Event() for _ in calls]
+        with self._rpc_lock:
+            self._rpc_pending.update(zip(request_ids, events))
+        try:
+            self._send_rpc(jsonrpc)
+            deadline = time.time() + self.rpc_timeout
+            for event in events:
+                event.wait(max(0, deadline - time.time()))
+        finally:
+            with self._rpc_lock:
+                responses = []
+                for request_id in request_ids:
+                    del self._rpc_pending[request_id]
+                    responses.append(
+                        self._rpc_results.pop(request_id, None))
+        for response in responses:
+            self._check_rpc_response(response)
+        return responses
+
+    def _check_rpc_response(self, response):
+        """Raise the error contained in an RPC response.
+
+        Args:
+          response: The response dict, None if the request timed out
+        """
+        if response is None:
+            raise RPCTimeout
         if 'error' in response:
             err = response['error']
             code = err['code']
             message = err['message']
-            # 'method not found' means the current connection is not
-            # authenticated
-            if code == -32601:
-                raise NotAuthenticated(message)
-            else:
-                raise MakerBotError(
-                    'RPC Error code=%s message=%s' % (code, message))
-        return response
+            error_class = _RPC_ERRORS.get(code, MakerBotError)
+            raise error_class(
+                'RPC Error code=%s message=%s' % (code, message))
 
     def get_system_information(self):
         """Get system information from MakerBot over JSON RPC.
@@ -606,60 +1031,70 @@ class Makerbot(object):
         """
         response = self.rpc_request_response(
             'get_system_information', '')
+        return self._parse_system_information(response)
+
+    def refresh_all(self):
+        """Perform the handshake and get the system information at once.
+
+        Both requests are sent as one JSON RPC batch, taking a single round
+        trip to the bot.
+
+        Returns:
+          A BotState object
+        """
+        handshake, system_information = self._batch_rpc_request_response(
+            [('handshake', self.default_params),
+             ('get_system_information', '')])
+        self._parse_handshake(handshake)
+        return self._parse_system_information(system_information)
+
+    def _parse_system_information(self, response):
+        """Create a BotState from a get_system_information response."""
         bot_state = BotState()
 
         # Uncommment this line to see the raw JSON the bot is sending
         # print json.dumps(response)
 
-        if not response['result']:
+        result = response['result']
+        if not result:
             raise UnexpectedJSONResponse(response)
-        if 'machine_name' not in response['result']:
+        if 'machine_name' not in result:
             raise UnexpectedJSONResponse(response)
-        json_machine_status = response['result']['machine_name']
-
-        for attr in ['step', 'extruder_temp', 'state', 'preheat_percent']:
+        json_machine_status = result['machine_name']
+        for attr in ('step', 'extruder_temp', 'state', 'preheat_percent'):
             if attr in json_machine_status:
                 setattr(bot_state, attr, json_machine_status[attr])
 
         # for now we just support one toolhead (are there any gen5 with
         # multiple heads anyway?)
         toolhead = Toolhead()
-        json_toolhead_status = response['result']['toolheads']['extruder'][0]
+        json_toolhead_status = result['toolheads']['extruder'][0]
         #json_toolhead_status = json_machine_status['toolhead_0_status']
-        for attr in ['tool_id',
-                     'filament_presence',
-                     'preheating',
-                     'index',
-                     'tool_present',
-                     'current_temperature',
-                     'target_temperature']:
-            if attr in json_toolhead_status:
-                setattr(toolhead, attr, json_toolhead_status[attr])
+        toolhead.tool_id = json_toolhead_status.get('tool_id')
+        toolhead.filament_presence = json_toolhead_status.get(
+            'filament_presence')
+        toolhead.preheating = json_toolhead_status.get('preheating')
+        toolhead.index = json_toolhead_status.get('index')
+        toolhead.tool_present = json_toolhead_status.get('tool_present')
+        toolhead.current_temperature = json_toolhead_status.get(
+            'current_temperature')
+        toolhead.target_temperature = json_toolhead_status.get(
+            'target_temperature')
 
         bot_state.toolheads.append(toolhead)
 
         # Check to see if there's a process happening.
-        if response['result']['current_process']:
+        json_current_process = result['current_process']
+        if json_current_process:
             # If the machine is doing something (loading filament, etc.), this
             # will not be None.
             current_bot_process = CurrentBotProcess()
-            json_current_process = response['result']['current_process']
-            for attr in ['username',
-                         'name',
-                         'cancellable',
-                         'temperature_settings',
-                         'tool_index',
-                         'step',
-                         'complete',
-                         'error',
-                         'cancelled',
-                         'reason',
-                         'id',
-                         'methods',
-                         'progress']:
-                if attr in json_current_process:
-                    setattr(
-                        current_bot_process, attr, json_current_process[attr])
+            process_dict = current_bot_process.__dict__
+            # Attributes missing from the response keep their defaults
+            for attr in _CURRENT_PROCESS_ATTRS:
+                value = json_current_process.get(attr, _MISSING)
+                if value is not _MISSING:
+                    process_dict[attr] = value
         else:
             current_bot_process = None
 
@@ -677,33 +1112,17 @@ class Makerbot(object):
             'disable_check_build_plate', '')
         return response
 
-    def _rgb_clamp(self, x):
-        """Clamp an RGB value between 0 and 255.
+    def _write_png(self, output, rgb, width, height):
+        """Write RGB pixels as returned by self._yuv_image_to_rgb() as PNG.
 
         Args:
-            x: Value to clamp
-
-        Returns:
-          The clamped value
-        """
-        if x < 0:
-            return 0
-        elif x > 255:
-            return 255
-        else:
-            return x
-
-    def _rgb_rows_to_png(self, rgb_rows, width, height, output_file):
-        """Save RGB rows as returned by self._yuv_to_rgb_rows() as PNG.
-
-        Args:
-            rgb_rows: RGB rows as returned by self._yuv_to_rgb_rows()
-            output_file: PNG file to save
+            output: File-like object to write the PNG to
+            rgb: RGB pixels as returned by self._yuv_image_to_rgb()
+            width: Width in pixels
+            height: Height in pixels
         """
-        f = open(output_file, 'wb')
         png_file = png.Writer(width, height)
-        png_file.write(f, rgb_rows)
-        f.close()
+        png_file.write_array(output, rgb)
 
     def save_camera_png(self, output_file):
         """Save an image from the MakerBot camera in PNG format.
@@ -712,56 +1131,198 @@ class Makerbot(object):
             output_file: PNG file to save.
         """
         _, width, height, _, yuv_image = self._get_raw_camera_image_data()
-        rgb_rows = self._yuv_to_rgb_rows(StringIO(yuv_image), width, height)
-        self._rgb_rows_to_png(rgb_rows, width, height, output_file)
+        rgb = self._yuv_image_to_rgb(yuv_image, width, height)
+        with open(output_file, 'wb') as f:
+            self._write_png(f, rgb, width, height)
 
     def get_camera_png(self):
         """Get image from the MakerBot camera in PNG format.
         """
         _, width, height, _, yuv_image = self._get_raw_camera_image_data()
-        rgb_rows = self._yuv_to_rgb_rows(StringIO(yuv_image), width, height)
-        png_file = png.Writer(width, height)
+        rgb = self._yuv_image_to_rgb(yuv_image, width, height)
         output = StringIO()
-        png_file.write(output, rgb_rows)
+        self._write_png(output, rgb, width, height)
         contents = output.getvalue()
         output.close()
         return contents
 
+    def _yuv_image_to_rgb(self, yuv_image, width, height):
+        """Convert a raw YUYV422 camera image to RGB pixels.
+
+        Uses libyuv if it is installed, then the vectorized NumPy conversion
+        if NumPy is available and falls back to the pure Python
+        implementation otherwise.
+
+        Args:
+            yuv_image: A string or buffer containing YUYV422 image data
+            width: Width in pixels
+            height: Height in pixels
+
+        Returns:
+          An array('B') containing the RGB pixel values of all rows.
+        """
+        if _libyuv is not None:
+            return self._yuv_to_rgb_libyuv(yuv_image, width, height)
+        if numpy is not None:
+            rgb = self._yuv_to_rgb_rows_np(yuv_image, width, height)
+            return array('B', rgb.tostring())
+        rgb_rows = self._yuv_to_rgb_rows(yuv_image, width, height)
+        return array('B', itertools.chain.from_iterable(rgb_rows))
+
+    def _yuv_to_rgb_libyuv(self, yuv_image, width, height):
+        """Convert YUYV422 to RGB pixels using libyuv.
+
+        Args:
+            yuv_image: A string or buffer containing YUYV422 image data
+            width: Width in pixels
+            height: Height in pixels
+
+        Returns:
+          An array('B') containing the RGB pixel values of all rows.
+
+        Raises:
+          ValueError: yuv_image is too short for width and height
+        """
+        # libyuv reads width * height * 2 bytes without any bounds check
+        if len(yuv_image) < width * height * 2:
+            raise ValueError('YUYV422 image of %dx%d needs %d bytes, got %d'
+                             % (width, height, width * height * 2,
+                                len(yuv_image)))
+        argb = ctypes.create_string_buffer(width * height * 4)
+        _libyuv.YUY2ToARGB(_buffer_address(yuv_image), width * 2,
+                           argb, width * 4, width, height)
+        # libyuv's RAW format is RGB in memory order
+        rgb = ctypes.create_string_buffer(width * height * 3)
+        _libyuv.ARGBToRAW(argb, width * 4, rgb, width * 3, width, height)
+        return array('B', rgb.raw)
+
+    def _yuv_to_rgb_rows_np(self, yuv_image, width, height):
+        """Convert YUYV422 to RGB pixels using NumPy.
+
+        Produces the same values as self._yuv_to_rgb_rows().
+
+        Args:
+            yuv_image: A string or buffer containing YUYV422 image data
+            width: Width in pixels
+            height: Height in pixels
+
+        Returns:
+          A (height, width * 3) uint8 array containing RGB pixel values.
+        """
+        yuyv = numpy.frombuffer(yuv_image, dtype=numpy.uint8,
+                                count=width * height * 2)
+        yuyv = yuyv.reshape(height, width // 2, 4).astype(numpy.int32)
+        # Luma of both pixels of a pair, chroma is shared between them
+        c = 298 * (yuyv[:, :, 0::2] - 16)
+        d = (yuyv[:, :, 1] - 128)[:, :, numpy.newaxis]
+        e = (yuyv[:, :, 3] - 128)[:, :, numpy.newaxis]
+
+        rgb = numpy.empty((height, width // 2, 2, 3), dtype=numpy.int32)
+        rgb[:, :, :, 0] = (c + 409 * e + 128) >> 8
+        rgb[:, :, :, 1] = (c - 100 * d - 208 * e + 128) >> 8
+        rgb[:, :, :, 2] = (c + 516 * d + 128) >> 8
+        numpy.clip(rgb, 0, 255, out=rgb)
+        rgb = rgb.astype(numpy.uint8)
+        return rgb.reshape(height, width * 3)
+
     def _yuv_to_rgb_rows(self, yuv_image, width, height):
         """Convert YUYV422 to RGB pixels.
 
         Args:
-            yuv_image: A file-like object containing YUYV422 image data
+            yuv_image: A string or buffer containing YUYV422 image data
             width: Width in pixels
             height: Height in pixels
 
         Returns:
           A list of lists containing RGB pixel values.
         """
-        rgb_rows = []
+        yuv_data = bytearray(yuv_image)
+        pos = 0
+        rgb_rows = [None] * height
         for row in range(0, height):
-            rgb_row = []
-            for column in range(0, width / 2):
+            rgb_row = [0] * (width * 3)
+            for column in range(0, width * 3, 6):
                 # http://en.wikipedia.org/wiki/YUV#Y.27UV422_to_RGB888_conversion
                 # Modified for MakerBot YUYV format
-                y1 = ord(yuv_image.read(1))
-                u = ord(yuv_image.read(1))
-                y2 = ord(yuv_image.read(1))
-                v = ord(yuv_image.read(1))
+                y1 = yuv_data[pos]
+                u = yuv_data[pos + 1]
+                y2 = yuv_data[pos + 2]
+                v = yuv_data[pos + 3]
+                pos += 4
 
                 # http://www.lems.brown.edu/vision/vxl_doc/html/core/vidl_vil1/html/vidl__vil1__yuv__2__rgb_8h.html
-                R = 1.164 * (y1 - 16) + 1.596 * (v - 128)
-                G = 1.164 * (y1 - 16) - 0.813 * (v - 128) - 0.391 * (u - 128)
-                B = 1.164 * (y1 - 16) + 2.018 * (u - 128)
-                rgb_row.append(self._rgb_clamp(int(R)))
-                rgb_row.append(self._rgb_clamp(int(G)))
-                rgb_row.append(self._rgb_clamp(int(B)))
-
-                R = 1.164 * (y2 - 16) + 1.596 * (v - 128)
-                G = 1.164 * (y2 - 16) - 0.813 * (v - 128) - 0.391 * (u - 128)
-                B = 1.164 * (y2 - 16) + 2.018 * (u - 128)
-                rgb_row.append(self._rgb_clamp(int(R)))
-                rgb_row.append(self._rgb_clamp(int(G)))
-                rgb_row.append(self._rgb_clamp(int(B)))
-            rgb_rows.append(rgb_row)
+                # Coefficients are scaled by 256 to use integer arithmetic,
+                # the chroma terms are shared by both pixels of the pair.
+                # Clamping with conditionals avoids two builtin calls each.
+                d = u - 128
+                e = v - 128
+                r_chroma = 409 * e + 128
+                g_chroma = -100 * d - 208 * e + 128
+                b_chroma = 516 * d + 128
+
+                c = 298 * (y1 - 16)
+                value = (c + r_chroma) >> 8
+                rgb_row[column] = (0 if value < 0 else
+                                   255 if value > 255 else value)
+                value = (c + g_chroma) >> 8
+                rgb_row[column + 1] = (0 if value < 0 else
+                                       255 if value > 255 else value)
+                value = (c + b_chroma) >> 8
+                rgb_row[column + 2] = (0 if value < 0 else
+                                       255 if value > 255 else value)
+
+                c = 298 * (y2 - 16)
+                value = (c + r_chroma) >> 8
+                rgb_row[column + 3] = (0 if value < 0 else
+                                       255 if value > 255 else value)
+                value = (c + g_chroma) >> 8
+                rgb_row[column + 4] = (0 if value < 0 else
+                                       255 if value > 255 else value)
+                value = (c + b_chroma) >> 8
+                rgb_row[column + 5] = (0 if value < 0 else
+                                       255 if value > 255 else value)
+            rgb_rows[row] = rgb_row
         return rgb_rows
+
+
+def get_system_information_all(bots):
+    """Get system information from several MakerBots concurrently.
+
+    The requests are sent to all bots before any response is awaited, so the
+    network round trips overlap instead of adding up. A bot that fails or
+    does not answer in time does not affect the results of the others.
+
+    Args:
+      bots: list of connected Makerbot objects
+
+    Returns:
+      A list with either the BotState object or the exception raised for
+      each bot, in the order of bots.
+    """
+    start_time = time.time()
+    requests = []
+    for bot in bots:
+        try:
+            requests.append(
+                bot._send_rpc_request('get_system_information', ''))
+        except Exception, e:
+            requests.append(e)
+    try:
+        for bot, request in zip(bots, requests):
+            if not isinstance(request, Exception):
+                bot._wait_rpc_response(
+                    request, start_time + bot.rpc_timeout - time.time())
+    finally:
+        responses = [request if isinstance(request, Exception)
+                     else bot._pop_rpc_response(request)
+                     for bot, request in zip(bots, requests)]
+    results = []
+    for bot, response in zip(bots, responses):
+        if not isinstance(response, Exception):
+            try:
+                bot._check_rpc_response(response)
+                response = bot._parse_system_information(response)
+            except Exception, e:
+                response = e
+        results.append(response)
+    return results
@@ -18,8 +18,13 @@
 
 """Unit tests for makerbotapi."""
 
+import httplib
+import itertools
 import os
+import shutil
 import socket
+import tempfile
+import threading
 import time
 import unittest
 import urllib2
@@ -40,6 +45,7 @@ FCGI_TOKEN_FAILED_RESPONSE = '{"status": "error", "message": "Access denied: aut
 
 JSONRPC_HANDSHAKE_RESPONSE = '{"result": {"commit": "5924ea5", "machine_type": "platypus", "ip": "169.254.0.79", "iserial": "1234567890ABCDEFG", "port": "9999", "firmware_version": {"minor": 2, "bugfix": 0, "major": 1, "build": 112}, "vid": 9153, "builder": "Release_Birdwing_1.0", "pid": 5, "machine_name": "MakerBot Replicator"}, "jsonrpc": "2.0", "id": 0}'
 JSONRPC_GET_SYTEM_INFORMATION_RESPONSE = '{"result": {"version": "0.0.1", "disabled_errors": [], "suspended_processes": {}, "machine_type": "tinkerbell", "machine": {"machine_error": 256, "move_buffer_available_space": 100, "step": "running", "extruder_temp": 29, "toolhead_0_status": {"current_mag": -256, "error": 0, "tool_id": 1, "filament_fan_running": false, "filament_presence": true, "extrusion_percent": 0, "filament_jam": false, "encoder_adc": 0}, "state": "idle", "preheat_percent": 0, "toolhead_0_heating_status": {"current_temperature": 29, "preheating": 0, "target_temperature": 0}}, "machine_name": "MakerBot Replicator Mini", "has_been_connected_to": true, "current_processes": {}, "ip": "192.168.23.44", "firmware_version": {"build": 112, "minor": 2, "bugfix": 0, "major": 1}}, "jsonrpc": "2.0", "id": 0}'
+JSONRPC_SYSTEM_INFORMATION_RESPONSE = '{"jsonrpc": "2.0", "id": 2, "result": {"sound": true, "has_been_connected_to": true, "machine_name": "MakerBot Replicator", "ip": "10.1.10.114", "bot_type": "replicator_5", "disabled_errors": [], "toolheads": {"extruder": [{"preheating": false, "filament_presence": true, "tool_id": 7, "index": 0, "tool_present": true, "current_temperature": 23, "target_temperature": 0}]}, "api_version": "1.4.0", "machine_type": "platypus", "firmware_version": {"bugfix": 1, "major": 1, "build": 305, "minor": 7}, "current_process": {"username": "conveyor", "name": "LoadFilamentProcess", "cancellable": true, "step": "heating", "id": 5, "progress": 12}}}'
 JSONRPC_NOT_AUTHENTICATED_RESPONSE = '{"id": 2, "jsonrpc": "2.0", "error": {"code": -32601, "message": "method not found"}}'
 JSONRPC_AUTHENTICATED_RESPONSE = '{"jsonrpc": "2.0", "result": null, "id": 0}'
 
@@ -49,6 +55,22 @@ BROADCAST_RESPONSE = '{"commit": "5924ea5", "machine_type": "platypus", "ip": "1
 mock_time = mock.Mock()
 
 
+def fcgi_response(content):
+    response = mock.Mock(status=httplib.OK)
+    response.read.return_value = content
+    return response
+
+
+def receive_rpc(makerbot, data):
+    """Handle data as if it was received on the JSON RPC socket."""
+    end = makerbot._rpc_buffer_len + len(data)
+    if end > len(makerbot._rpc_buffer):
+        makerbot._rpc_buffer.extend(bytearray(end - len(makerbot._rpc_buffer)))
+    makerbot._rpc_buffer[makerbot._rpc_buffer_len:end] = data
+    makerbot._rpc_buffer_len = end
+    makerbot._handle_rpc_buffer()
+
+
 class MakerbotTest(unittest.TestCase):
 
     def setUp(self):
@@ -60,25 +82,61 @@ class MakerbotTest(unittest.TestCase):
 
         socket.socket = mock.Mock(return_value=self.handle)
         urllib2.urlopen = mock.Mock()
+        self.http = mock.Mock()
+        httplib.HTTPConnection = mock.Mock(return_value=self.http)
 
         self.makerbot = makerbotapi.Makerbot(
             '169.254.0.79', auto_connect=False)
 
+    def _respond_with(self, response):
+        """Make the bot answer the next request with response."""
+        def sendall(jsonrpc):
+            dic = json.loads(response)
+            dic['id'] = json.loads(jsonrpc)['id']
+            receive_rpc(self.makerbot, json.dumps(dic))
+        self.handle.sendall.side_effect = sendall
+
+    def test_socket_options(self):
+        self.handle.setsockopt.assert_any_call(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.handle.setsockopt.reset_mock()
+        makerbotapi.Makerbot('169.254.0.79', auto_connect=False,
+                             socket_options=[])
+        self.assertFalse(self.handle.setsockopt.called)
+
     @mock.patch('time.sleep', mock.Mock())
     def test_authenticate_fcgi(self):
-        urllib2.urlopen.side_effect = [StringIO(FCGI_CODE_RESPONSE),
-                                       StringIO(FCGI_ANSWER_PENDING_RESPONSE),
-                                       StringIO(FCGI_ANSWER_ACCEPTED_RESPONSE)]
+        self.http.getresponse.side_effect = [
+            fcgi_response(FCGI_CODE_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE),
+            fcgi_response(FCGI_ANSWER_ACCEPTED_RESPONSE)]
+        self.makerbot.authenticate_fcgi()
+
+        self.assertEqual(self.makerbot.auth_code, 'abcde')
+
+    @mock.patch('time.sleep')
+    def test_authenticate_fcgi_backoff(self, sleep_mock):
+        self.makerbot.fcgi_retry_interval = 0.5
+        self.http.getresponse.side_effect = [
+            fcgi_response(FCGI_CODE_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE),
+            fcgi_response(FCGI_ANSWER_ACCEPTED_RESPONSE)]
         self.makerbot.authenticate_fcgi()
 
         self.assertEqual(self.makerbot.auth_code, 'abcde')
+        self.assertEqual([args[0] for args, _ in sleep_mock.call_args_list],
+                         [0.25, 0.4, 0.5])
 
     @mock.patch('time.time', mock_time)
     @mock.patch('time.sleep', mock.Mock())
     def test_authenticate_fcgi_timeout(self):
-        urllib2.urlopen.side_effect = [StringIO(FCGI_CODE_RESPONSE),
-                                       StringIO(FCGI_ANSWER_PENDING_RESPONSE),
-                                       StringIO(FCGI_ANSWER_PENDING_RESPONSE)]
+        self.http.getresponse.side_effect = [
+            fcgi_response(FCGI_CODE_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE),
+            fcgi_response(FCGI_ANSWER_PENDING_RESPONSE)]
         mock_time.side_effect = [1,
                                  self.makerbot.auth_timeout - 5,
                                  self.makerbot.auth_timeout + 1]
@@ -88,10 +146,7 @@ class MakerbotTest(unittest.TestCase):
 
     def test_do_handshake(self):
 
-        self.handle.recv.return_value = JSONRPC_HANDSHAKE_RESPONSE
-        self.makerbot._get_request_id = mock.Mock(return_value=10)
-        self.makerbot.rpc_id_responses[
-            10] = json.loads(JSONRPC_HANDSHAKE_RESPONSE)
+        self._respond_with(JSONRPC_HANDSHAKE_RESPONSE)
 
         self.makerbot.do_handshake()
 
@@ -107,7 +162,7 @@ class MakerbotTest(unittest.TestCase):
         self.assertEqual(self.makerbot.vid, 9153)
 
     def test_get_access_token(self):
-        urllib2.urlopen.return_value = StringIO(FCGI_TOKEN_RESPONSE)
+        self.http.getresponse.return_value = fcgi_response(FCGI_TOKEN_RESPONSE)
         self.assertEqual(
             self.makerbot.get_access_token('jsonrpc'), '12345abcde')
 
@@ -115,7 +170,7 @@ class MakerbotTest(unittest.TestCase):
                           self.makerbot.get_access_token,
                           'test')
 
-        urllib2.urlopen.return_value = StringIO(FCGI_TOKEN_FAILED_RESPONSE)
+        self.http.getresponse.return_value = fcgi_response(FCGI_TOKEN_FAILED_RESPONSE)
         self.assertRaises(makerbotapi.AuthenticationError,
                           self.makerbot.get_access_token,
                           'jsonrpc')
@@ -138,20 +193,133 @@ class MakerbotTest(unittest.TestCase):
 #        self.assertEqual(toolhead.preheating, 0)
 #        self.assertEqual(toolhead.target_temperature, 0)
 
+    def test_get_system_information_toolhead(self):
+        self._respond_with(JSONRPC_SYSTEM_INFORMATION_RESPONSE)
+        botstate = self.makerbot.get_system_information()
+
+        # Looked up in the machine_name string, which does not contain them
+        self.assertEqual(botstate.step, None)
+        self.assertEqual(botstate.extruder_temp, None)
+        self.assertEqual(botstate.state, None)
+        self.assertEqual(botstate.preheat_percent, None)
+
+        self.assertEqual(botstate.get_tool_head_count(), 1)
+        toolhead = botstate.toolheads[0]
+        self.assertEqual(toolhead.tool_id, 7)
+        self.assertEqual(toolhead.filament_presence, True)
+        self.assertEqual(toolhead.preheating, False)
+        self.assertEqual(toolhead.index, 0)
+        self.assertEqual(toolhead.tool_present, True)
+        self.assertEqual(toolhead.current_temperature, 23)
+        self.assertEqual(toolhead.target_temperature, 0)
+
+        process = botstate.current_process
+        self.assertEqual(process.name, 'LoadFilamentProcess')
+        self.assertEqual(process.cancellable, True)
+        self.assertEqual(process.step, 'heating')
+        self.assertEqual(process.id, 5)
+        self.assertEqual(process.progress, 12)
+        self.assertEqual(process.error, None)
+
+    def test_refresh_all(self):
+        def sendall(jsonrpc):
+            requests = json.loads(jsonrpc)
+            self.assertEqual([request['method'] for request in requests],
+                             ['handshake', 'get_system_information'])
+            responses = [json.loads(JSONRPC_HANDSHAKE_RESPONSE),
+                         json.loads(JSONRPC_SYSTEM_INFORMATION_RESPONSE)]
+            for request, response in zip(requests, responses):
+                response['id'] = request['id']
+            # The bot may answer the requests of a batch in any order
+            receive_rpc(self.makerbot, json.dumps(responses[::-1]))
+        self.handle.sendall.side_effect = sendall
+
+        botstate = self.makerbot.refresh_all()
+
+        self.assertEqual(self.handle.sendall.call_count, 1)
+        self.assertEqual(self.makerbot.machine_type, 'platypus')
+        self.assertEqual(botstate.toolheads[0].tool_id, 7)
+        self.assertEqual(self.makerbot._rpc_pending, {})
+
+    def test_refresh_all_timeout(self):
+        self.makerbot.rpc_timeout = 0
+        self.assertRaises(makerbotapi.RPCTimeout, self.makerbot.refresh_all)
+        self.assertEqual(self.makerbot._rpc_pending, {})
+
     def testNotAuthenticated(self):
-        self.handle.recv.return_value = JSONRPC_NOT_AUTHENTICATED_RESPONSE
-        self.makerbot._get_request_id = mock.Mock(return_value=10)
-        self.makerbot.rpc_id_responses[10] = json.loads(
-            JSONRPC_NOT_AUTHENTICATED_RESPONSE)
+        self._respond_with(JSONRPC_NOT_AUTHENTICATED_RESPONSE)
         self.assertRaises(
             makerbotapi.NotAuthenticated, self.makerbot.get_system_information)
 
+    def test__send_fcgi_reconnect(self):
+        self.http.getresponse.side_effect = [httplib.BadStatusLine(''),
+                                             fcgi_response(FCGI_TOKEN_RESPONSE)]
+        self.assertEqual(
+            self.makerbot.get_access_token('jsonrpc'), '12345abcde')
+        self.assertEqual(self.http.close.call_count, 1)
+        self.assertEqual(self.http.request.call_count, 2)
+
+    def test__send_fcgi_timeout(self):
+        self.http.getresponse.side_effect = socket.timeout
+        self.assertRaises(socket.timeout,
+                          self.makerbot.get_access_token, 'jsonrpc')
+        self.assertEqual(self.http.close.call_count, 1)
+        self.assertEqual(self.http.request.call_count, 1)
+
+    def test_rpc_request_response_send_error(self):
+        self.handle.sendall.side_effect = socket.error
+        self.assertRaises(socket.error,
+                          self.makerbot.rpc_request_response, 'handshake', '')
+        self.assertEqual(self.makerbot._rpc_pending, {})
+
+    def test_get_system_information_all(self):
+        other_handle = mock.Mock()
+        socket.socket = mock.Mock(return_value=other_handle)
+        other = makerbotapi.Makerbot('169.254.0.80', auto_connect=False)
+        responses = []
+
+        def sendall(makerbot, jsonrpc):
+            # Answer only once both requests were sent
+            responses.append((makerbot, json.loads(jsonrpc)['id']))
+            if len(responses) == 2:
+                for makerbot, request_id in responses:
+                    dic = json.loads(JSONRPC_SYSTEM_INFORMATION_RESPONSE)
+                    dic['id'] = request_id
+                    receive_rpc(makerbot, json.dumps(dic))
+        self.handle.sendall.side_effect = \
+            lambda jsonrpc: sendall(self.makerbot, jsonrpc)
+        other_handle.sendall.side_effect = \
+            lambda jsonrpc: sendall(other, jsonrpc)
+
+        botstates = makerbotapi.get_system_information_all(
+            [self.makerbot, other])
+
+        self.assertEqual(len(botstates), 2)
+        self.assertEqual(botstates[1].toolheads[0].tool_id, 7)
+        self.assertEqual(self.makerbot._rpc_pending, {})
+        self.assertEqual(other._rpc_pending, {})
+
+    def test_get_system_information_all_timeout(self):
+        failing_handle = mock.Mock()
+        failing_handle.sendall.side_effect = socket.error
+        socket.socket = mock.Mock(side_effect=[failing_handle, mock.Mock()])
+        failing = makerbotapi.Makerbot('169.254.0.80', auto_connect=False)
+        silent = makerbotapi.Makerbot('169.254.0.81', auto_connect=False)
+        silent.rpc_timeout = 0.01
+        self._respond_with(JSONRPC_SYSTEM_INFORMATION_RESPONSE)
+
+        results = makerbotapi.get_system_information_all(
+            [failing, self.makerbot, silent])
+
+        self.assertTrue(isinstance(results[0], socket.error))
+        self.assertEqual(results[1].toolheads[0].tool_id, 7)
+        self.assertTrue(isinstance(results[2], makerbotapi.RPCTimeout))
+        for bot in (failing, self.makerbot, silent):
+            self.assertEqual(bot._rpc_pending, {})
+
     def test_authenticate_json_rpc(self):
-        urllib2.urlopen.return_value = StringIO(FCGI_TOKEN_RESPONSE)
-        self.handle.recv.return_value = JSONRPC_AUTHENTICATED_RESPONSE
-        self.makerbot._get_request_id = mock.Mock(return_value=10)
-        self.makerbot.rpc_id_responses[10] = json.loads(
-            JSONRPC_AUTHENTICATED_RESPONSE)
+        self.http.getresponse.return_value = fcgi_response(FCGI_TOKEN_RESPONSE)
+        self._respond_with(JSONRPC_AUTHENTICATED_RESPONSE)
         self.makerbot.authenticate_json_rpc()
         self.assertTrue(self.makerbot.jsonrpc_authenticated)
 
@@ -164,15 +332,204 @@ class MakerbotTest(unittest.TestCase):
         tpl = self.makerbot._get_raw_camera_image_data()
         self.assertEquals(tpl[:4], (153616, 320, 240, 1))
 
-    def test__rpc_get_next_message(self):
-        self.assertEqual(
-            self.makerbot._rpc_get_next_message("{foo}"), ("{foo}", ""),)
+    @unittest.skipIf(makerbotapi.numpy is None, 'requires numpy')
+    def test__yuv_to_rgb_rows_np(self):
+        curr_path = os.path.dirname(__file__)
+        camera_response = os.path.join(
+            curr_path, 'test_output/camera_response')
+        urllib2.urlopen.return_value = open(camera_response)
+        self.makerbot.get_access_token = mock.Mock(return_value='abcdef1234')
+        _, width, height, _, yuv_image = \
+            self.makerbot._get_raw_camera_image_data()
+
+        expected = self.makerbot._yuv_to_rgb_rows(yuv_image, width, height)
+        rgb = self.makerbot._yuv_to_rgb_rows_np(yuv_image, width, height)
+        self.assertEqual(rgb.shape, (height, width * 3))
+        self.assertEqual(rgb.tolist(), expected)
+
+    @unittest.skipIf(makerbotapi._libyuv is None, 'requires libyuv')
+    def test__yuv_to_rgb_libyuv(self):
+        curr_path = os.path.dirname(__file__)
+        camera_response = os.path.join(
+            curr_path, 'test_output/camera_response')
+        urllib2.urlopen.return_value = open(camera_response)
+        self.makerbot.get_access_token = mock.Mock(return_value='abcdef1234')
+        _, width, height, _, yuv_image = \
+            self.makerbot._get_raw_camera_image_data()
+
+        expected = self.makerbot._yuv_to_rgb_rows(yuv_image, width, height)
+        rgb = self.makerbot._yuv_to_rgb_libyuv(yuv_image, width, height)
+        self.assertEqual(len(rgb), width * height * 3)
+        # libyuv rounds slightly differently
+        for value, expected_value in zip(rgb, itertools.chain(*expected)):
+            self.assertTrue(abs(value - expected_value) <= 2)
+
+    @unittest.skipIf(makerbotapi._libyuv is None, 'requires libyuv')
+    def test__yuv_to_rgb_libyuv_short_image(self):
+        self.assertRaises(ValueError, self.makerbot._yuv_to_rgb_libyuv,
+                          buffer('\x80' * 100), 320, 240)
+
+    def test__generate_json_rpc(self):
+        params = {'username': 'conveyor'}
+        jsonrpc = self.makerbot._generate_json_rpc('handshake', params, 1)
+        self.assertEqual(json.loads(jsonrpc), {'id': 1,
+                                               'jsonrpc': '2.0',
+                                               'method': 'handshake',
+                                               'params': params})
+
+        params['username'] = 'other'
+        jsonrpc = self.makerbot._generate_json_rpc('handshake', params, 2)
+        self.assertEqual(json.loads(jsonrpc), {'id': 2,
+                                               'jsonrpc': '2.0',
+                                               'method': 'handshake',
+                                               'params': params})
+
+        jsonrpc = self.makerbot._generate_json_rpc('handshake', '', 3)
+        self.assertEqual(json.loads(jsonrpc), {'id': 3,
+                                               'jsonrpc': '2.0',
+                                               'method': 'handshake'})
+
+        params = self.makerbot.default_params
+        for request_id in (4, 5):
+            jsonrpc = self.makerbot._generate_json_rpc(
+                'handshake', params, request_id)
+            self.assertEqual(json.loads(jsonrpc), {'id': request_id,
+                                                   'jsonrpc': '2.0',
+                                                   'method': 'handshake',
+                                                   'params': params})
+        # Calls with other params are not cached
+        self.makerbot._generate_json_rpc('authenticate', {'a': 1}, 6)
+        self.assertEqual(sorted(self.makerbot._rpc_templates), ['handshake'])
+
+    def test__handle_rpc_buffer(self):
+        events = {0: threading.Event(), 2: threading.Event()}
+        self.makerbot._rpc_pending.update(events)
+        receive_rpc(self.makerbot, JSONRPC_HANDSHAKE_RESPONSE + '\n' +
+                    JSONRPC_NOT_AUTHENTICATED_RESPONSE)
+        self.assertEqual(self.makerbot._rpc_buffer_len, 0)
+        self.assertTrue(events[0].is_set())
+        self.assertEqual(self.makerbot._rpc_results[0],
+                         json.loads(JSONRPC_HANDSHAKE_RESPONSE))
+        self.assertTrue(events[2].is_set())
+        self.assertEqual(self.makerbot._rpc_results[2],
+                         json.loads(JSONRPC_NOT_AUTHENTICATED_RESPONSE))
+
+        notification = '{"jsonrpc": "2.0", "method": "state_notification", "params": {"info": "{"}}'
+        receive_rpc(self.makerbot,
+                    notification + JSONRPC_AUTHENTICATED_RESPONSE[:10])
         self.assertEqual(
-            self.makerbot._rpc_get_next_message("{foo}{bar}"), ("{foo}", "{bar}"),)
-        self.assertEqual(self.makerbot._rpc_get_next_message(
-            "{foo}{bar{baz}}"), ("{foo}", "{bar{baz}}"),)
-        self.assertEqual(self.makerbot._rpc_get_next_message(
-            "{foo{baz}}{bar{baz}}"), ("{foo{baz}}", "{bar{baz}}"),)
+            self.makerbot._rpc_buffer[:self.makerbot._rpc_buffer_len],
+            JSONRPC_AUTHENTICATED_RESPONSE[:10])
+        self.assertEqual(list(self.makerbot.rpc_unsolicited_messages),
+                         [json.loads(notification)])
+
+        # The rest of the message completes it
+        events[0].clear()
+        receive_rpc(self.makerbot, JSONRPC_AUTHENTICATED_RESPONSE[10:])
+        self.assertTrue(events[0].is_set())
+        self.assertEqual(self.makerbot._rpc_buffer_len, 0)
+
+    def test__handle_rpc_buffer_bytewise(self):
+        notification = '{"method": "log", "params": {"text": "\\"}{\\\\"}}'
+        for char in notification + notification:
+            receive_rpc(self.makerbot, char)
+        self.assertEqual(list(self.makerbot.rpc_unsolicited_messages),
+                         [json.loads(notification)] * 2)
+        self.assertEqual(self.makerbot._rpc_buffer_len, 0)
+
+    @mock.patch('sys.stderr', mock.Mock())
+    def test__handle_rpc_buffer_invalid(self):
+        event = threading.Event()
+        self.makerbot._rpc_pending[0] = event
+        # A malformed message must not block the ones after it
+        receive_rpc(self.makerbot, 'garbage {"id": 1, "result": nul} ' +
+                    JSONRPC_HANDSHAKE_RESPONSE)
+        self.assertEqual(self.makerbot._rpc_buffer_len, 0)
+        self.assertTrue(event.is_set())
+
+    @mock.patch('sys.stderr', mock.Mock())
+    def test_rpc_reader_message_too_large(self):
+        self.makerbot.rpc_max_message_size = 64
+        self.makerbot._rpc_buffer = bytearray(16)
+
+        def recv_into(view):
+            view[:len(view)] = '[' * len(view)
+            return len(view)
+        # Not a Mock, which would keep the view and pin the buffer size
+        self.handle.recv_into = recv_into
+
+        # Grows from 16 to 64 bytes
+        for _ in range(3):
+            self.makerbot._rpc_socket_readable()
+        self.assertEqual(len(self.makerbot._rpc_buffer), 64)
+        self.assertFalse(self.handle.close.called)
+        self.makerbot._rpc_socket_readable()
+        self.assertTrue(self.handle.close.called)
+        self.assertFalse(self.makerbot.jsonrpc_connected)
+
+    def test_rpc_reader(self):
+        bot_socket, self.makerbot.rpc_socket = socket.socketpair()
+        # Small enough to need growing for the response
+        self.makerbot._rpc_buffer = bytearray(16)
+        makerbotapi._reactor.register(self.makerbot.rpc_socket,
+                                      self.makerbot._rpc_socket_readable)
+        event = threading.Event()
+        self.makerbot._rpc_pending[0] = event
+
+        bot_socket.sendall(JSONRPC_HANDSHAKE_RESPONSE[:20])
+        bot_socket.sendall(JSONRPC_HANDSHAKE_RESPONSE[20:])
+        self.assertTrue(event.wait(1))
+        self.assertEqual(self.makerbot._rpc_results[0],
+                         json.loads(JSONRPC_HANDSHAKE_RESPONSE))
+        self.assertEqual(self.makerbot._rpc_buffer_len, 0)
+
+        self.makerbot._disconnect_json_rpc()
+        bot_socket.close()
+
+    def test_rpc_reader_large_message(self):
+        bot_socket, self.makerbot.rpc_socket = socket.socketpair()
+        makerbotapi._reactor.register(self.makerbot.rpc_socket,
+                                      self.makerbot._rpc_socket_readable)
+        event = threading.Event()
+        self.makerbot._rpc_pending[2] = event
+
+        response = json.loads(JSONRPC_SYSTEM_INFORMATION_RESPONSE)
+        response['result']['disabled_errors'] = ['error'] * 20000
+        data = json.dumps(response)
+        self.assertTrue(len(data) > len(self.makerbot._rpc_buffer))
+        for pos in range(0, len(data), 1000):
+            bot_socket.sendall(data[pos:pos + 1000])
+        self.assertTrue(event.wait(1))
+        self.assertEqual(self.makerbot._rpc_results[2], response)
+
+        self.makerbot._disconnect_json_rpc()
+        bot_socket.close()
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = makerbotapi.Config()
+        self.config.fname = os.path.join(self.tmpdir, 'config.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_discards_unsaved_changes(self):
+        self.config.load()
+        self.config.addBot(('10.1.10.114', 'MakerBot Replicator', '1234'))
+        self.config.save()
+
+        # Unsaved changes are discarded by reloading the file
+        self.config.addBot(('10.1.10.115', 'MakerBot Replicator', '5678'))
+        self.config.getBotInfo('1234')['machine name'] = 'MakerBot S2'
+        self.config.data['bots']['1234']['ip'] = '9.9.9.9'
+        self.config.load()
+        self.assertEqual(self.config.data['bots'].keys(), ['1234'])
+        self.assertEqual(self.config.getBotInfo('1234')['machine name'],
+                         'MakerBot Replicator')
+        self.assertEqual(self.config.getBotInfo('1234')['ip'], '10.1.10.114')
 
 
 class ModuleTest(unittest.TestCase):
@@ -184,16 +541,36 @@ class ModuleTest(unittest.TestCase):
         self.handle.recvfrom.return_value = ('', '1.2.3.4')
         self.handle.close = mock.Mock()
 
-    def test_discover(self):
+    @mock.patch('select.select')
+    def test_discover(self, select_mock):
         sock_mock = mock.Mock()
         sock_mock.recvfrom.return_value = (
             BROADCAST_RESPONSE, ('192.168.1.1', 12345))
         socket.socket = mock.Mock(return_value=sock_mock)
+        select_mock.side_effect = [([sock_mock], [], []),
+                                   ([sock_mock], [], []),
+                                   ([], [], [])]
         socks = makerbotapi.createSockets()
         ans = makerbotapi.discover(socks)
         self.assertEquals(
             ans, [('192.168.1.1', u'MakerBot Replicator', u'1234567890ABCDEFG')])
 
 
+    @mock.patch('time.time')
+    @mock.patch('select.select')
+    def test_discover_ends_on_time(self, select_mock, time_mock):
+        sock_mock = mock.Mock()
+        sock_mock.recvfrom.return_value = (
+            BROADCAST_RESPONSE, ('192.168.1.1', 12345))
+        socket.socket = mock.Mock(return_value=sock_mock)
+        # Answers keep arriving after the sleep window
+        select_mock.return_value = ([sock_mock], [], [])
+        time_mock.side_effect = [0, 0, 0.5, 0.5, 1.5, 1.5, 2]
+        socks = makerbotapi.createSockets()
+        ans = makerbotapi.discover(socks)
+        self.assertEqual(len(ans), 1)
+        self.assertEqual(sock_mock.recvfrom.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()